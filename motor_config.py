@@ -0,0 +1,21 @@
+# Shared Motor Configuration
+# Imported by server.py and the offline tools (system_id.py) so both use the same motor
+# and control rate without the tools importing the whole server
+# ------------------------------------------------------------------------------------
+
+# --- Motor Parameters ---
+Type = 'AK80-9'
+ID = 2
+
+# --- Control Loop Frequency ---
+MOTOR_UPDATE_FREQUENCY = 100 # Hz
+MOTOR_UPDATE_INTERVAL = 1.0 / MOTOR_UPDATE_FREQUENCY # Time interval in seconds
+
+# --- Session Logging ---
+# server.py records one row per control tick here; system_id.py fits from these logs
+# About 200 bytes per row, so ~70 MB per hour at 100 Hz; off by default to spare the SD card
+SESSION_LOG_DIR = None # e.g. 'logs' (relative to server.py) to enable session logging
+SESSION_LOG_MAX_BYTES = 200 * 1000 * 1000 # Per session; logging stops for the session once reached
+SESSION_LOG_KEEP = 5 # Session logs kept in SESSION_LOG_DIR, including the new one; older ones are deleted
+SESSION_LOG_COLUMNS = ("timestamp", "rx_timestamp", "position", "velocity", "current", "temperature", "error",
+                       "control_mode", "cmd_position", "cmd_velocity", "cmd_current", "cmd_kp", "cmd_kd")
@@ -5,7 +5,9 @@
 
 import asyncio
 import websockets
+import csv
 import json
+import os
 import time
 import traceback
 import numpy as np
@@ -21,10 +23,18 @@ except ImportError:
     print("Install with: pip install git+https://github.com/mit-biomimetics/TMotorCANControl.git")
     sys.exit(1)
 
+from socketcan_async import TMotorManager_mit_socketcan
 
-# --- Motor Parameters ---
-Type = 'AK80-9'
-ID = 2
+# --- Motor Parameters, Control Loop Frequency and Session Logging (shared with system_id.py) ---
+from motor_config import (Type, ID, MOTOR_UPDATE_FREQUENCY, MOTOR_UPDATE_INTERVAL,
+                          SESSION_LOG_DIR, SESSION_LOG_COLUMNS, SESSION_LOG_MAX_BYTES, SESSION_LOG_KEEP)
+
+# --- CAN Backend Configuration ---
+# 'python-can': TMotorCANControl's own CAN manager (Notifier thread, always on 'can0')
+# 'asyncio': event-driven SocketCAN reader on the server's event loop; also publishes "rx_timestamp",
+#            the kernel receive time of the latest reply ("timestamp" stays the publish time)
+CAN_BACKEND = 'python-can'
+CAN_CHANNEL = 'can0' # Used by the 'asyncio' backend, e.g. 'vcan0' for testing without hardware
 
 # --- WebSocket Server Configuration ---
 HOST = '10.196.34.53' #'10.42.0.1'
@@ -36,18 +46,37 @@ ADMIN_PASSWORD = "mysecretpassword"
 # -------------------------------------
 
 
-# --- Control Loop Frequency ---
-MOTOR_UPDATE_FREQUENCY = 100 # Hz
-MOTOR_UPDATE_INTERVAL = 1.0 / MOTOR_UPDATE_FREQUENCY # Time interval in seconds
-
 # --- WebSocket State Send Frequency ---
 STATE_SEND_FREQUENCY = 50 # Hz (e.g., half the update rate)
 STATE_SEND_INTERVAL = 1.0 / STATE_SEND_FREQUENCY # Time interval in seconds
 
 
+# --- Emergency Stop Configuration ---
+# Commands routed through the priority stop path (checked before JSON parsing and the command queue)
+EMERGENCY_STOP_COMMANDS = ("emergency_stop", "power_off")
+# Commands that are dropped if they were queued before an emergency stop arrived
+PREEMPTIBLE_COMMANDS = ("set_full_state_params", "power_on", "zero")
+# Messages each client may have waiting for 'process_commands'; more are rejected.
+# A newer 'set_full_state_params' replaces a waiting one instead of taking a slot.
+COMMAND_QUEUE_SIZE = 16
+
+
 # --- Global shared state variables ---
 shared_motor_state = {}
 
+# --- Global emergency stop state ---
+# Latched by a stop; new setpoints are rejected until 'power_on' clears it
+emergency_stop_latched = False
+# time.perf_counter() at which the latest stop message was received
+last_emergency_stop_time = float("-inf")
+# Latency from stop message receipt to the CAN power_off write, in milliseconds
+stop_latency_stats = {"count": 0, "last_ms": None, "max_ms": None, "mean_ms": None}
+# Stops whose power_off frame was queued because the CAN transmit queue was full
+stop_deferred_count = 0
+# Event loop timing from motor_update_task, in milliseconds: how late each tick wakes
+# (time spent queued behind other callbacks) and the longest synchronous tick
+loop_lag_stats = {"last_ms": None, "max_ms": None, "tick_max_ms": None}
+
 # --- Global variable to track the 'Admin' client ---
 # Stores the websocket object of the client that has the 'Admin' role
 current_admin_websocket = None # Renamed from current_doctor_websocket
@@ -56,12 +85,191 @@ current_admin_websocket = None # Renamed from current_doctor_websocket
 is_admin_password_set = False # New state variable, False on server start
 
 
+# --- Priority Emergency Stop Path ---
+def match_priority_stop(message):
+    """
+    Returns the stop command name if the raw message is an emergency stop, else None.
+    A plain substring check rejects ordinary traffic without parsing it.
+    """
+    if not isinstance(message, str):
+        return None
+    if '"emergency_stop"' not in message and '"power_off"' not in message:
+        return None
+    try:
+        data = json.loads(message)
+    except json.JSONDecodeError:
+        return None
+    command_type = data.get("command") if isinstance(data, dict) else None
+    return command_type if command_type in EMERGENCY_STOP_COMMANDS else None
+
+
+def is_setpoint_message(message) -> bool:
+    """
+    Returns True if the raw message is a 'set_full_state_params' command.
+    """
+    if not isinstance(message, str) or '"set_full_state_params"' not in message:
+        return False
+    try:
+        data = json.loads(message)
+    except json.JSONDecodeError:
+        return False
+    return isinstance(data, dict) and data.get("command") == "set_full_state_params"
+
+
+def apply_emergency_stop(dev: TMotorManager_mit_can, received_at: float):
+    """
+    Zeroes the commands, latches the stop and sends power_off on the CAN bus right away,
+    without waiting for the next control tick.
+    Returns (latency in milliseconds, deferred). deferred is True when the backend queued
+    the power_off frame behind a full transmit queue instead of writing it; such stops
+    are counted separately and not included in the latency stats.
+    """
+    global emergency_stop_latched
+    global last_emergency_stop_time
+    global stop_deferred_count
+
+    emergency_stop_latched = True
+    last_emergency_stop_time = max(last_emergency_stop_time, received_at)
+
+    # Set internal commands to zero as a safety measure before power_off
+    dev.set_impedance_gains_real_unit_full_state_feedback(K=0.0, B=0.0) # Zero gains first
+    dev.position = 0.0
+    dev.velocity = 0.0
+    dev.current_qaxis = 0.0
+    dev._control_state = _TMotorManState.IDLE # Transition to idle internally
+    dev.power_off() # Send the CAN command
+
+    latency_ms = (time.perf_counter() - received_at) * 1000.0
+    if getattr(getattr(dev, "_canman", None), "last_tx_deferred", False):
+        stop_deferred_count += 1
+        return latency_ms, True
+    count = stop_latency_stats["count"] + 1
+    previous_mean = stop_latency_stats["mean_ms"] or 0.0
+    stop_latency_stats.update({
+        "count": count,
+        "last_ms": latency_ms,
+        "max_ms": max(stop_latency_stats["max_ms"] or 0.0, latency_ms),
+        "mean_ms": previous_mean + (latency_ms - previous_mean) / count,
+    })
+    return latency_ms, False
+
+
+def stop_report() -> dict:
+    """
+    Returns the stop latency and event loop timing fields published to clients.
+    Stop latency is measured from when 'receive_commands' gets the message (after
+    websockets has read and framed it) to the CAN power_off write. A stop can also wait
+    behind the longest synchronous callback on the loop before it is read, so
+    stop_latency_worst_observed_ms adds the worst observed loop lag or motor tick to the
+    worst measured stop. It is an observation, not a guarantee: it excludes network and
+    websockets time and can be exceeded by delays not seen yet.
+    """
+    loop_wait_ms = max(loop_lag_stats["max_ms"] or 0.0, loop_lag_stats["tick_max_ms"] or 0.0)
+    return {
+        "stop_count": stop_latency_stats["count"],
+        "stop_deferred_count": stop_deferred_count,
+        "stop_latency_ms": stop_latency_stats["last_ms"],
+        "stop_latency_max_ms": stop_latency_stats["max_ms"],
+        "stop_latency_mean_ms": stop_latency_stats["mean_ms"],
+        "loop_lag_ms": loop_lag_stats["last_ms"],
+        "loop_lag_max_ms": loop_lag_stats["max_ms"],
+        "motor_tick_max_ms": loop_lag_stats["tick_max_ms"],
+        "stop_latency_worst_observed_ms": (stop_latency_stats["max_ms"] or 0.0) + loop_wait_ms,
+    }
+
+
+async def handle_priority_stop(websocket, dev: TMotorManager_mit_can, stop_command: str, received_at: float):
+    """
+    Applies an emergency stop ahead of any queued commands and reports its latency.
+    """
+    try:
+        latency_ms, deferred = apply_emergency_stop(dev, received_at)
+        report = stop_report()
+        # Log only after the CAN write so printing never delays the stop
+        if deferred:
+            print(f"Emergency stop ({stop_command}) from {websocket.remote_address}: CAN transmit queue full, "
+                  f"power_off queued after {latency_ms:.3f} ms and will be written as soon as the bus accepts it.")
+            await websocket.send(json.dumps({
+                "status": "success",
+                "message": "Motor power off command queued (CAN transmit queue full).",
+                "stop_deferred": True,
+                **report,
+            }))
+            return
+        print(f"Emergency stop ({stop_command}) from {websocket.remote_address}: power_off sent via CAN in {latency_ms:.3f} ms "
+              f"(max {report['stop_latency_max_ms']:.3f} ms over {report['stop_count']} stops, "
+              f"worst observed incl. loop lag {report['stop_latency_worst_observed_ms']:.3f} ms).")
+        await websocket.send(json.dumps({
+            "status": "success",
+            "message": "Motor power off command sent.",
+            "stop_deferred": False,
+            **report,
+        }))
+    except websockets.exceptions.ConnectionClosed:
+        raise
+    except Exception as e:
+        print(f"Emergency stop error sending power_off command: {e}")
+        traceback.print_exc()
+        await websocket.send(json.dumps({"status": "error", "message": f"Error sending power_off: {e}"}))
+
+
+# --- Motor Manager Construction ---
+def create_motor_manager():
+    """
+    Creates the motor manager for the configured CAN_BACKEND.
+    The 'asyncio' backend must be created while the event loop is running.
+    """
+    if CAN_BACKEND == 'asyncio':
+        return TMotorManager_mit_socketcan(motor_type=Type, motor_ID=ID, max_mosfett_temp=75, channel=CAN_CHANNEL)
+    return TMotorManager_mit_can(motor_type=Type, motor_ID=ID, max_mosfett_temp=75)
+
+
+def reply_timestamp(dev):
+    """
+    Returns the kernel receive time of the latest motor reply when the backend provides it,
+    otherwise None. Unlike the publish "timestamp", it stops advancing when replies stop.
+    """
+    return getattr(dev, "rx_timestamp", None)
+
+
+# --- Session Log ---
+def open_session_log():
+    """
+    Opens a new CSV session log in SESSION_LOG_DIR with one row per control tick, after
+    deleting the oldest session logs so at most SESSION_LOG_KEEP remain.
+    Returns (file, writer), or (None, None) when session logging is disabled or fails.
+    """
+    if SESSION_LOG_DIR is None:
+        return None, None
+    log_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), SESSION_LOG_DIR)
+    try:
+        os.makedirs(log_dir, exist_ok=True)
+        # Names carry the start time, so sorting them sorts the sessions oldest first
+        old_logs = sorted(name for name in os.listdir(log_dir) if name.startswith("session_") and name.endswith(".csv"))
+        for name in old_logs[:max(len(old_logs) - (SESSION_LOG_KEEP - 1), 0)]:
+            os.remove(os.path.join(log_dir, name))
+            print(f"Deleted old session log {name}")
+        path = os.path.join(log_dir, time.strftime("session_%Y%m%d_%H%M%S.csv"))
+        log_file = open(path, 'w', newline='')
+        writer = csv.writer(log_file)
+        writer.writerow(SESSION_LOG_COLUMNS)
+        print(f"Recording session log at {MOTOR_UPDATE_FREQUENCY} Hz to {path} "
+              f"(up to {SESSION_LOG_MAX_BYTES / 1e6:.0f} MB)")
+        return log_file, writer
+    except OSError as e:
+        print(f"Warning: Could not open session log in '{SESSION_LOG_DIR}': {e}")
+        return None, None
+
+
 # --- Async Task for Continuous Motor Update ---
-async def motor_update_task(dev: TMotorManager_mit_can, shared_state_arg: dict, interval=MOTOR_UPDATE_INTERVAL):
+async def motor_update_task(dev: TMotorManager_mit_can, shared_state_arg: dict, interval=MOTOR_UPDATE_INTERVAL, session_log=None):
     """
     Continuously updates motor state and updates shared state.
+    Writes one row per successful update to session_log (a csv writer), if given,
+    until SESSION_LOG_MAX_BYTES have been written.
     """
     print("Task 'motor_update_task' started.")
+    session_log_bytes = 0
 
     try:
         while True:
@@ -71,11 +279,12 @@ async def motor_update_task(dev: TMotorManager_mit_can, shared_state_arg: dict,
             # --- Update Motor State ---
             try:
                 # This sends the current command and gets the latest state
-                # The command values in dev._command are updated by receive_commands
-                # The mode in dev._control_state is updated by receive_commands
+                # The command values in dev._command are updated by process_commands
+                # The mode in dev._control_state is updated by process_commands
                 dev.update()
                 current_motor_state = {
                     "timestamp": time.time(),
+                    "rx_timestamp": reply_timestamp(dev),
                     "position": dev.position,
                     "velocity": dev.velocity,
                     "current": dev.current_qaxis,
@@ -89,6 +298,8 @@ async def motor_update_task(dev: TMotorManager_mit_can, shared_state_arg: dict,
                     "cmd_current": dev._command.current,
                     "cmd_kp": dev._command.kp,
                     "cmd_kd": dev._command.kd,
+                    "stop_latched": emergency_stop_latched,
+                    **stop_report(),
                 }
                 # Add error description based on motor error code
                 if current_motor_state["error"] != 0:
@@ -98,6 +309,12 @@ async def motor_update_task(dev: TMotorManager_mit_can, shared_state_arg: dict,
                 else:
                      current_motor_state["error_description"] = ""
 
+                if session_log is not None:
+                    session_log_bytes += session_log.writerow([current_motor_state[name] for name in SESSION_LOG_COLUMNS])
+                    if session_log_bytes >= SESSION_LOG_MAX_BYTES:
+                        print(f"Session log reached {SESSION_LOG_MAX_BYTES / 1e6:.0f} MB; recording stopped for this session.")
+                        session_log = None
+
 
             except RuntimeError as e:
                 print(f"Motor Runtime Error during dev.update(): {e}")
@@ -135,9 +352,15 @@ async def motor_update_task(dev: TMotorManager_mit_can, shared_state_arg: dict,
             # --- Maintain Update Frequency ---
             end_time = time.time();
             elapsed_time = end_time - start_time;
+            loop_lag_stats["tick_max_ms"] = max(loop_lag_stats["tick_max_ms"] or 0.0, elapsed_time * 1000.0)
             sleep_duration = interval - elapsed_time;
             if sleep_duration > 0:
+                 wake_time = time.perf_counter() + sleep_duration
                  await asyncio.sleep(sleep_duration);
+                 # How late the loop resumed us: time queued behind other callbacks
+                 lag_ms = max(time.perf_counter() - wake_time, 0.0) * 1000.0
+                 loop_lag_stats["last_ms"] = lag_ms
+                 loop_lag_stats["max_ms"] = max(loop_lag_stats["max_ms"] or 0.0, lag_ms)
 
 
     except asyncio.CancelledError:
@@ -230,20 +453,83 @@ async def send_state(websocket, shared_state_arg: dict, interval=STATE_SEND_INTE
 
 
 # --- Async Task for Receiving Commands ---
-async def receive_commands(websocket, dev: TMotorManager_mit_can):
+async def receive_commands(websocket, dev: TMotorManager_mit_can, command_queue: asyncio.Queue):
     """
-    Async task to receive and process commands from the WebSocket client.
+    Async task to read messages from the WebSocket client as soon as they arrive.
+    Emergency stops ('emergency_stop' from any client, 'power_off' from the Admin) are
+    applied immediately; everything else is queued for 'process_commands'.
+    At most one 'set_full_state_params' waits in the queue: a newer one overwrites it in
+    place, so a client streaming setpoints faster than they are processed only ever has
+    its latest setpoint applied. Other commands are dropped while the queue is full,
+    without a reply, so the reader never waits on a send and keeps seeing stops.
+    """
+    print("Task 'receive_commands' started for a client.")
+    # Holds the waiting setpoint under "entry"; the dict itself is the queue item, and
+    # 'process_commands' pops the entry when it takes it
+    setpoint_slot = {}
+    dropped = 0 # Messages dropped in the current burst of queue-full rejections
+    try:
+        async for message in websocket:
+            received_at = time.perf_counter()
+            stop_command = match_priority_stop(message)
+            if stop_command is not None and not (stop_command == "power_off" and websocket != current_admin_websocket):
+                await handle_priority_stop(websocket, dev, stop_command, received_at)
+                continue
+
+            # Ordinary traffic, or a non-Admin power_off which the normal path rejects
+            if is_setpoint_message(message):
+                if "entry" in setpoint_slot:
+                    setpoint_slot["entry"] = (received_at, message) # Supersedes the waiting setpoint
+                    continue
+                if command_queue.qsize() < COMMAND_QUEUE_SIZE:
+                    setpoint_slot["entry"] = (received_at, message)
+                    command_queue.put_nowait(setpoint_slot)
+                    dropped = 0
+                    continue
+            elif command_queue.qsize() < COMMAND_QUEUE_SIZE:
+                command_queue.put_nowait((received_at, message))
+                dropped = 0
+                continue
+            dropped += 1
+            if dropped == 1:
+                print(f"Command queue full for {websocket.remote_address}; dropping messages until it drains.")
+
+    except websockets.exceptions.ConnectionClosed:
+        print(f"Client {websocket.remote_address} WebSocket connection closed in receive_commands task.")
+    except asyncio.CancelledError:
+         print(f"Task 'receive_commands' cancelled for {websocket.remote_address}.")
+    except Exception as e:
+        print(f"Error in receive_commands task for {websocket.remote_address}: {e}")
+        traceback.print_exc()
+    finally:
+        # Tell 'process_commands' that no more messages will arrive
+        command_queue.put_nowait(None)
+    print(f"Task 'receive_commands' finished for client {websocket.remote_address}.")
+
+
+# --- Async Task for Processing Commands ---
+async def process_commands(websocket, dev: TMotorManager_mit_can, command_queue: asyncio.Queue):
+    """
+    Async task to process queued commands from the WebSocket client.
     Commands modify the internal dev._command and dev._control_state.
     Only accepts standard commands from the 'Admin' client.
     Handles 'request_admin_role' and 'release_admin_role'.
+    Drops commands that were queued before an emergency stop arrived.
     """
     global current_admin_websocket # Need to read and write to the global variable
     global is_admin_password_set # Need to read and write to the global variable
+    global emergency_stop_latched # Need to clear the latch on power_on
     global ADMIN_PASSWORD # Need to read the global variable
 
-    print("Task 'receive_commands' started for a client.")
+    print("Task 'process_commands' started for a client.")
     try:
-        async for message in websocket:
+        while True:
+            queued = await command_queue.get()
+            if queued is None:
+                break # Reader finished, connection is closed
+            if isinstance(queued, dict):
+                queued = queued.pop("entry") # Latest setpoint from the reader's setpoint slot
+            received_at, message = queued
             try:
                 data = json.loads(message)
                 command_type = data.get("command")
@@ -331,6 +617,15 @@ async def receive_commands(websocket, dev: TMotorManager_mit_can):
                     }))
                     continue # Skip processing the rest of the command
 
+                # --- Drop commands preempted by an emergency stop ---
+                elif command_type in PREEMPTIBLE_COMMANDS and received_at < last_emergency_stop_time:
+                    print(f"Dropped command '{command_type}' from {websocket.remote_address}: queued before an emergency stop.")
+                    await websocket.send(json.dumps({"status": "error", "message": f"Command '{command_type}' preempted by emergency stop."}))
+
+                elif command_type == "set_full_state_params" and emergency_stop_latched:
+                    print("Admin Command: Rejected set_full_state_params while emergency stop is latched.")
+                    await websocket.send(json.dumps({"status": "error", "message": "Motor is stopped. Send power_on before new setpoints."}))
+
                 # If we reach here, it's a standard command AND the client is the Admin
                 elif command_type == "set_full_state_params":
                     try:
@@ -364,29 +659,18 @@ async def receive_commands(websocket, dev: TMotorManager_mit_can):
                          await websocket.send(json.dumps({"status": "error", "message": f"Server error setting params: {e}"}))
 
 
-                elif command_type == "power_off":
-                     print("Admin Command: Received power_off command.") # Changed text
-                     # Set internal commands to zero as a safety measure before power_off
-                     dev.set_impedance_gains_real_unit_full_state_feedback(K=0.0, B=0.0) # Zero gains first
-                     dev.position = 0.0
-                     dev.velocity = 0.0
-                     dev.current_qaxis = 0.0
-                     dev._control_state = _TMotorManState.IDLE # Transition to idle internally
-
-                     try:
-                          dev.power_off() # Send the CAN command
-                          print("Admin Command: Motor power_off command sent via CAN.") # Changed text
-                          await websocket.send(json.dumps({"status": "success", "message": "Motor power off command sent."}))
-                     except Exception as e:
-                           print(f"Admin Command Error sending power_off command: {e}") # Changed text
-                           traceback.print_exc()
-                           await websocket.send(json.dumps({"status": "error", "message": f"Error sending power_off: {e}"}))
+                elif command_type in EMERGENCY_STOP_COMMANDS:
+                     # Normally handled by the priority path in receive_commands; reached when the
+                     # client only became Admin after the stop message had been read.
+                     print(f"Admin Command: Received {command_type} command.")
+                     await handle_priority_stop(websocket, dev, command_type, received_at)
 
 
                 elif command_type == "power_on":
                      print("Admin Command: Received power_on command.") # Changed text
                      try:
                          dev.power_on()
+                         emergency_stop_latched = False # Setpoints are accepted again
                          print("Admin Command: Motor power_on command sent via CAN.") # Changed text
                          # --- After power_on, server defaults to MIT and safe gains ---
                          # This is consistent with how the server starts
@@ -409,7 +693,7 @@ async def receive_commands(websocket, dev: TMotorManager_mit_can):
                 elif command_type == "zero":
                      print("Admin Command: Received zero command.") # Changed text
                      # Note: The app sends zero params first, then zero command.
-                     # The server's receive_commands task processes messages sequentially from one client.
+                     # The server's process_commands task processes messages sequentially from one client.
                      # If the zero command arrives immediately after set_full_state_params with zeros,
                      # the motor_update_task might send one frame with zero params before the zero command.
                      # This is generally acceptable.
@@ -440,20 +724,20 @@ async def receive_commands(websocket, dev: TMotorManager_mit_can):
                 except websockets.exceptions.ConnectionClosed: pass
 
     except websockets.exceptions.ConnectionClosed:
-        print(f"Client {websocket.remote_address} WebSocket connection closed in receive_commands task.")
+        print(f"Client {websocket.remote_address} WebSocket connection closed in process_commands task.")
     except asyncio.CancelledError:
-         print(f"Task 'receive_commands' cancelled for {websocket.remote_address}.")
+         print(f"Task 'process_commands' cancelled for {websocket.remote_address}.")
     except Exception as e:
-        print(f"Error in receive_commands task for {websocket.remote_address}: {e}")
+        print(f"Error in process_commands task for {websocket.remote_address}: {e}")
         traceback.print_exc()
-    print(f"Task 'receive_commands' finished for client {websocket.remote_address}.")
+    print(f"Task 'process_commands' finished for client {websocket.remote_address}.")
 
 
 # --- Async WebSocket Handler ---
 async def handler(websocket, dev: TMotorManager_mit_can, shared_state_arg: dict):
     """
     Handles a new WebSocket connection.
-    Starts receive and send tasks.
+    Starts receive, process and send tasks.
     Cleans up admin role if the admin client disconnects.
     """
     global current_admin_websocket # Need to read the global variable
@@ -472,12 +756,16 @@ async def handler(websocket, dev: TMotorManager_mit_can, shared_state_arg: dict)
             print(f"Warning: Client {websocket.remote_address} disconnected before receiving initial state.")
 
 
-    receive_task = asyncio.create_task(receive_commands(websocket, dev))
+    # Messages waiting for 'process_commands'; emergency stops bypass this queue.
+    # One extra slot is kept for the end-of-stream marker from 'receive_commands'
+    command_queue = asyncio.Queue(maxsize=COMMAND_QUEUE_SIZE + 1)
+    receive_task = asyncio.create_task(receive_commands(websocket, dev, command_queue))
+    process_task = asyncio.create_task(process_commands(websocket, dev, command_queue))
     send_task = asyncio.create_task(send_state(websocket, shared_state_arg))
 
     try:
-        # Wait for either task to finish (usually due to connection closure)
-        await asyncio.gather(receive_task, send_task)
+        # Wait for the tasks to finish (usually due to connection closure)
+        await asyncio.gather(receive_task, process_task, send_task)
     except asyncio.CancelledError:
         print(f"Handler tasks cancelled for client {websocket.remote_address}.")
     except Exception as e:
@@ -492,7 +780,7 @@ async def handler(websocket, dev: TMotorManager_mit_can, shared_state_arg: dict)
             print(f"Admin client {websocket.remote_address} disconnected. Admin role released.") # Changed text
 
         # Ensure all tasks for this client are cancelled
-        for task in [receive_task, send_task]:
+        for task in [receive_task, process_task, send_task]:
             if not task.done():
                 task.cancel()
                 try:
@@ -547,13 +835,14 @@ async def main():
 
     motor_manager = None
     motor_task = None
+    session_log_file = None
     websocket_server_task = None
 
 
     try:
-        print(f"Attempting to connect to motor {ID} ({Type}...)...")
+        print(f"Attempting to connect to motor {ID} ({Type}...) using the '{CAN_BACKEND}' CAN backend...")
         # Using the 'with' statement ensures dev.power_off() is called on exit
-        with TMotorManager_mit_can(motor_type=Type, motor_ID=ID, max_mosfett_temp=75) as dev:
+        with create_motor_manager() as dev:
             motor_manager = dev
             print(f"Motor {ID} ({Type}) connected.")
 
@@ -577,6 +866,7 @@ async def main():
                  # Populate shared state with initial data
                  shared_motor_state.update({
                      "timestamp": time.time(),
+                     "rx_timestamp": reply_timestamp(dev),
                      "position": dev.position,
                      "velocity": dev.velocity,
                      "current": dev.current_qaxis,
@@ -622,8 +912,9 @@ async def main():
             print("Motor initialized and ready.")
 
             # --- Start the continuous motor update task ---
+            session_log_file, session_log = open_session_log()
             motor_task = asyncio.create_task(
-                motor_update_task(dev, shared_motor_state, MOTOR_UPDATE_INTERVAL)
+                motor_update_task(dev, shared_motor_state, MOTOR_UPDATE_INTERVAL, session_log)
             )
             print("Continuous motor update task started.")
 
@@ -686,6 +977,16 @@ async def main():
                  print(f"Error while waiting for server task cancellation: {e}")
                  traceback.print_exc()
 
+         # Release the CAN socket only once no task can send on it; close() waits
+         # briefly for the final power off if the transmit queue is full
+         if isinstance(motor_manager, TMotorManager_mit_socketcan):
+             motor_manager.close()
+
+         # Close the session log once the motor task has stopped writing to it
+         if session_log_file is not None:
+             session_log_file.close()
+             print("Session log closed.")
+
          print("Main function finished.")
 
 
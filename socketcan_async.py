@@ -0,0 +1,400 @@
+# Event-Driven SocketCAN Backend for T-Motor Control
+# Replaces TMotorCANControl's python-can Notifier thread with a reader on the asyncio event loop
+# Status replies are decoded as they arrive and stamped with the kernel receive time,
+# and commands are written without blocking the control tick
+# ------------------------------------------------------------------------------------
+#
+# Used by server.py when CAN_BACKEND = 'asyncio'. Works on 'can0' or a virtual interface:
+#   sudo modprobe vcan
+#   sudo ip link add dev vcan0 type vcan
+#   sudo ip link set up vcan0
+#   python3 socketcan_async.py vcan0    # self-test against a simulated motor
+
+import asyncio
+import collections
+import errno
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+
+try:
+    from TMotorCANControl.mit_can import TMotorManager_mit_can, CAN_Manager, MIT_Params, LOG_VARIABLES
+except ImportError:
+    print("Error: TMotorCANControl library not found. Please ensure it's in your path.")
+    print("Install with: pip install git+https://github.com/mit-biomimetics/TMotorCANControl.git")
+    sys.exit(1)
+
+
+# --- SocketCAN Constants ---
+CAN_FRAME = struct.Struct("=IB3x8s") # struct can_frame: can_id, dlc, padding, data[8]
+CAN_ERR_FLAG = 0x20000000
+CAN_RTR_FLAG = 0x40000000
+SO_TIMESTAMPNS = getattr(socket, "SO_TIMESTAMPNS", 35) # Kernel receive timestamp as struct timespec
+ANCDATA_SIZE = socket.CMSG_SPACE(16)
+# Power on/off and zero frames are 0xFF x7 followed by 0xFC/0xFD/0xFE; everything else is a setpoint
+CONTROL_CODE_PREFIX = bytes([0xFF] * 7)
+POWER_OFF_PAYLOAD = CONTROL_CODE_PREFIX + bytes([0xFD])
+
+# --- Transmit Settings ---
+TX_RETRY_INTERVAL = 0.0005 # seconds between retries while the interface transmit queue is full
+TX_CLOSE_TIMEOUT = 0.2 # seconds close() keeps retrying deferred frames (e.g. the final power_off)
+TX_BUSY_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS)
+
+
+def kernel_timestamp(ancdata):
+    """
+    Returns the SO_TIMESTAMPNS receive time (seconds, same clock as time.time()) or None.
+    """
+    for level, cmsg_type, payload in ancdata:
+        if level == socket.SOL_SOCKET and cmsg_type == SO_TIMESTAMPNS:
+            # struct timespec is two native longs: 16 bytes on 64-bit, 8 bytes on 32-bit Pi OS
+            sec, nsec = struct.unpack_from("@qq" if len(payload) >= 16 else "@ll", payload)
+            return sec + nsec * 1e-9
+    return None
+
+
+# --- CAN Manager on the Event Loop ---
+class AsyncSocketCANManager(CAN_Manager):
+    """
+    Drop-in replacement for CAN_Manager backed by a non-blocking raw SocketCAN socket.
+    Frames are read by a callback registered on the event loop for the socket's file
+    descriptor, and sends never wait for the bus.
+    """
+    def __new__(cls, *args, **kwargs):
+        # Skip CAN_Manager's singleton, which restarts 'can0' with sudo and starts a Notifier thread
+        return object.__new__(cls)
+
+    def __init__(self, channel='can0', loop=None, sock=None):
+        """
+        Opens the socket on channel and registers the reader on loop (default: the running loop).
+        """
+        if getattr(self, "_opened", False):
+            return # CAN_Manager() calls __init__ again on the installed instance
+
+        self.channel = channel
+        self.loop = loop or asyncio.get_running_loop()
+        self.motors = {}
+        self.rx_frames = 0
+        self.tx_deferred = 0
+        self.tx_dropped = 0
+        self.last_tx_deferred = False # True if the last send_MIT_message was queued, not written
+        self._pending = collections.deque() # (motor_id, frame, is_setpoint)
+        self._retry_handle = None
+
+        if sock is None:
+            sock = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+            sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+            sock.bind((channel,))
+        sock.setblocking(False)
+        self.sock = sock
+        self.loop.add_reader(self.sock.fileno(), self._on_readable)
+        self._opened = True
+        print(f"Connected on: {channel} (asyncio SocketCAN reader)")
+
+    def __del__(self):
+        # CAN_Manager.__del__ takes 'can0' down with sudo; only release our own socket
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """
+        Unregisters the reader, retries deferred frames for up to TX_CLOSE_TIMEOUT seconds
+        and closes the socket. Frames still deferred after that are counted as dropped.
+        """
+        if not getattr(self, "_opened", False):
+            return
+        self._opened = False
+        if self._retry_handle is not None:
+            self._retry_handle.cancel()
+            self._retry_handle = None
+        try:
+            self.loop.remove_reader(self.sock.fileno())
+        except (RuntimeError, ValueError):
+            pass # Loop already closed
+
+        # The loop may not run again, so wait for the interface queue here
+        deadline = time.monotonic() + TX_CLOSE_TIMEOUT
+        self._flush_pending()
+        while self._pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            select.select([], [self.sock], [], remaining)
+            self._flush_pending()
+            if self._pending:
+                # SocketCAN can report writable while the driver queue is still full (ENOBUFS)
+                time.sleep(min(TX_RETRY_INTERVAL, max(deadline - time.monotonic(), 0.0)))
+        if self._pending:
+            print(f"CAN transmit queue on {self.channel} still full after {TX_CLOSE_TIMEOUT} s; "
+                  f"dropping {len(self._pending)} deferred frame(s) on close.")
+            self.tx_dropped += len(self._pending)
+            self._pending.clear()
+        self.sock.close()
+
+    def add_motor(self, motor):
+        """
+        Subscribes a motor so replies carrying its ID update its state.
+        """
+        self.motors[motor.ID] = motor
+
+    # --- Transmit ---
+    def send_MIT_message(self, motor_id, data):
+        """
+        Writes an MIT Mode frame without blocking. If the interface transmit queue is
+        full the frame is deferred and retried from the event loop, keeping frame order,
+        and last_tx_deferred is set so callers can tell it has not reached the bus yet.
+        A power_off preempts the frames already deferred for its motor and goes first.
+        """
+        DLC = len(data)
+        assert (DLC <= 8), ('Data too long in message for motor ' + str(motor_id))
+        payload = bytes(data)
+        frame = CAN_FRAME.pack(motor_id, DLC, payload.ljust(8, b'\x00'))
+        is_setpoint = payload[:7] != CONTROL_CODE_PREFIX
+
+        self.last_tx_deferred = False
+        if payload == POWER_OFF_PAYLOAD:
+            self._send_stop(motor_id, frame)
+            return
+        if self._pending:
+            self._defer(motor_id, frame, is_setpoint)
+            return
+        try:
+            self.sock.send(frame)
+        except OSError as e:
+            if e.errno not in TX_BUSY_ERRNOS:
+                raise
+            self._defer(motor_id, frame, is_setpoint)
+
+    def _send_stop(self, motor_id, frame):
+        """
+        Drops every frame still deferred for motor_id, since they were all commanded before
+        the stop, then writes the power_off frame or defers it at the front of the queue.
+        """
+        preempted = [entry for entry in self._pending if entry[0] == motor_id]
+        for entry in preempted:
+            self._pending.remove(entry)
+        self.tx_dropped += len(preempted)
+        try:
+            self.sock.send(frame)
+        except OSError as e:
+            if e.errno not in TX_BUSY_ERRNOS:
+                raise
+            self._pending.appendleft((motor_id, frame, False))
+            self._mark_deferred()
+
+    def _defer(self, motor_id, frame, is_setpoint):
+        """
+        Queues a frame for retry. A new setpoint supersedes any queued setpoint for the
+        same motor, so the queue stays bounded; other control frames are only dropped
+        when a power_off for the same motor preempts them (see _send_stop).
+        """
+        if is_setpoint:
+            superseded = [entry for entry in self._pending if entry[0] == motor_id and entry[2]]
+            for entry in superseded:
+                self._pending.remove(entry)
+            self.tx_dropped += len(superseded)
+        self._pending.append((motor_id, frame, is_setpoint))
+        self._mark_deferred()
+
+    def _mark_deferred(self):
+        self.tx_deferred += 1
+        self.last_tx_deferred = True
+        if self._retry_handle is None and self._opened:
+            self._retry_handle = self.loop.call_later(TX_RETRY_INTERVAL, self._retry_pending)
+
+    def _retry_pending(self):
+        self._retry_handle = None
+        self._flush_pending()
+        if self._pending and self._opened:
+            self._retry_handle = self.loop.call_later(TX_RETRY_INTERVAL, self._retry_pending)
+
+    def _flush_pending(self):
+        while self._pending:
+            try:
+                self.sock.send(self._pending[0][1])
+            except OSError as e:
+                if e.errno not in TX_BUSY_ERRNOS:
+                    print(f"CAN send error on {self.channel}: {e}")
+                    self.tx_dropped += len(self._pending)
+                    self._pending.clear()
+                return
+            self._pending.popleft()
+
+    # --- Receive ---
+    def _on_readable(self):
+        """
+        Event loop callback: drains every queued frame and updates the matching motor.
+        """
+        while True:
+            try:
+                frame, ancdata, _, _ = self.sock.recvmsg(CAN_FRAME.size, ANCDATA_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print(f"CAN receive error on {self.channel}: {e}")
+                return
+            if len(frame) == CAN_FRAME.size:
+                self._handle_frame(frame, kernel_timestamp(ancdata) or time.time())
+
+    def _handle_frame(self, frame, rx_time):
+        can_id, dlc, data = CAN_FRAME.unpack(frame)
+        if can_id & (CAN_ERR_FLAG | CAN_RTR_FLAG) or dlc not in (6, 8):
+            return
+        motor = self.motors.get(data[0])
+        if motor is None:
+            return
+        self.rx_frames += 1
+        try:
+            motor._update_state_async(self.parse_MIT_message(data[:dlc], motor.type), rx_time)
+        except RuntimeError as e:
+            # Raised from the motor's next update(), like a failed synchronous exchange
+            motor._rx_error = e
+
+    def poll(self, timeout):
+        """
+        Waits up to timeout seconds for frames and decodes them without the event loop.
+        Used while the loop is blocked, e.g. during the connection check in __enter__.
+        """
+        readable, _, _ = select.select([self.sock], [], [], max(timeout, 0.0))
+        if readable:
+            self._on_readable()
+
+
+# --- Motor Manager on the Event Loop ---
+class TMotorManager_mit_socketcan(TMotorManager_mit_can):
+    """
+    TMotorManager_mit_can on the AsyncSocketCANManager backend. The control interface is
+    unchanged; update() only sends the command and uses the newest reply, whose kernel
+    receive time is available as rx_timestamp. Must be created while the loop is running.
+    """
+    def __init__(self, motor_type='AK80-9', motor_ID=1, max_mosfett_temp=50, channel='can0', CSV_file=None, log_vars=LOG_VARIABLES, loop=None):
+        self.rx_timestamp = None
+        self._rx_error = None
+        manager = AsyncSocketCANManager(channel, loop)
+        # The base constructor takes the CAN_Manager singleton; install ours for its duration
+        previous_instance = CAN_Manager._instance
+        CAN_Manager._instance = manager
+        try:
+            super().__init__(motor_type=motor_type, motor_ID=motor_ID, max_mosfett_temp=max_mosfett_temp, CSV_file=CSV_file, log_vars=log_vars)
+        finally:
+            CAN_Manager._instance = previous_instance
+
+    def close(self):
+        """Closes the CAN socket. Call after the final power_off."""
+        self._canman.close()
+
+    def _update_state_async(self, MIT_state, rx_time=None):
+        """
+        Stores the state from a reply received at rx_time (kernel timestamp).
+
+        Raises:
+            RuntimeError when device sends back an error code that is not 0 (0 meaning no error)
+        """
+        if MIT_state.error:
+            raise RuntimeError('Driver board error for device: ' + self.device_info_string() + ": " + MIT_Params['ERROR_CODES'].get(MIT_state.error, 'Unknown Motor Error'))
+
+        rx_time = time.time() if rx_time is None else rx_time
+        dt = rx_time - self._last_update_time
+        self._last_update_time = rx_time
+        acceleration = (MIT_state.velocity - self._motor_state_async.velocity)/dt if dt > 0 else self._motor_state_async.acceleration
+
+        # The "Current" supplied by the controller is actually current*Kt, which approximates torque.
+        self._motor_state_async.set_state(MIT_state.position, MIT_state.velocity, self.TMotor_current_to_qaxis_current(MIT_state.current), MIT_state.temperature, MIT_state.error, acceleration)
+        self.rx_timestamp = rx_time
+        self._updated = True
+
+    def update(self):
+        """
+        Raises any driver error received since the last tick, then syncs the newest
+        reply and sends the current command (without waiting for the bus).
+        """
+        if self._rx_error is not None:
+            error, self._rx_error = self._rx_error, None
+            raise error
+        super().update()
+
+    def check_can_connection(self):
+        """
+        Sends 10 power on messages and waits up to 1 s for 10 replies.
+
+        Returns:
+            True if a connection is established and False otherwise.
+        """
+        if not self._entered:
+            raise RuntimeError("Tried to check_can_connection before entering motor control! Enter control using the __enter__ method, or instantiating the TMotorManager in a with block.")
+        received = self._canman.rx_frames
+        for i in range(10):
+            self.power_on()
+            time.sleep(0.001)
+        deadline = time.time() + 1.0
+        while self._canman.rx_frames - received < 10 and time.time() < deadline:
+            self._canman.poll(deadline - time.time())
+        return self._canman.rx_frames - received >= 10
+
+
+# --- Self-Test Against a Simulated Motor ---
+def simulated_motor(channel, motor_type, motor_ID, stop_event):
+    """
+    Answers every frame addressed to motor_ID with a status reply, like an idle motor.
+    Runs in a thread on its own socket so it also answers while the loop is blocked.
+    """
+    sock = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+    sock.bind((channel,))
+    sock.settimeout(0.1)
+    limits = MIT_Params[motor_type]
+    position = CAN_Manager.float_to_uint(0.5, limits['P_min'], limits['P_max'], 16)
+    velocity = CAN_Manager.float_to_uint(0.0, limits['V_min'], limits['V_max'], 12)
+    current = CAN_Manager.float_to_uint(0.0, limits['T_min'], limits['T_max'], 12)
+    reply = bytes([motor_ID, position >> 8, position & 0xFF, velocity >> 4,
+                   ((velocity & 0xF) << 4) | (current >> 8), current & 0xFF, 30, 0])
+    while not stop_event.is_set():
+        try:
+            can_id, _, _ = CAN_FRAME.unpack(sock.recv(CAN_FRAME.size))
+        except socket.timeout:
+            continue
+        if can_id == motor_ID:
+            sock.send(CAN_FRAME.pack(0, len(reply), reply))
+    sock.close()
+
+
+async def self_test(channel, motor_type='AK80-9', motor_ID=1, ticks=500, interval=0.01):
+    """
+    Runs the control tick against a simulated motor and reports update() cost and reply timing.
+    """
+    stop_event = threading.Event()
+    motor_thread = threading.Thread(target=simulated_motor, args=(channel, motor_type, motor_ID, stop_event), daemon=True)
+    motor_thread.start()
+    tick_costs = []
+    reply_delays = []
+    try:
+        with TMotorManager_mit_socketcan(motor_type=motor_type, motor_ID=motor_ID, channel=channel) as dev:
+            for i in range(ticks):
+                start = time.perf_counter()
+                sent_at = time.time()
+                dev.update()
+                tick_costs.append(time.perf_counter() - start)
+                await asyncio.sleep(interval)
+                if dev.rx_timestamp is not None and dev.rx_timestamp >= sent_at:
+                    reply_delays.append(dev.rx_timestamp - sent_at)
+        dev.close()
+    finally:
+        stop_event.set()
+        motor_thread.join()
+
+    tick_costs.sort()
+    print(f"update() cost over {ticks} ticks: median {tick_costs[len(tick_costs) // 2] * 1e6:.1f} us, max {tick_costs[-1] * 1e6:.1f} us")
+    if reply_delays:
+        reply_delays.sort()
+        print(f"Reply received {len(reply_delays)}/{ticks} ticks, kernel timestamp after send: "
+              f"median {reply_delays[len(reply_delays) // 2] * 1e6:.1f} us, max {reply_delays[-1] * 1e6:.1f} us")
+    else:
+        print("No replies received from the simulated motor.")
+
+
+if __name__ == '__main__':
+    asyncio.run(self_test(sys.argv[1] if len(sys.argv) > 1 else 'vcan0'))
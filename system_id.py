@@ -0,0 +1,302 @@
+# Offline System Identification for the Exoskeleton Joint
+# Runs on the Raspberry Pi between sessions (or any machine with the logs)
+# Fits joint inertia, damping, friction and torque constant from recorded CSV logs
+# and recommends Kp/Kd ranges for 'set_full_state_params'
+# ------------------------------------------------------------------------------------
+#
+# Usage:
+#   python3 system_id.py logs/session_*.csv
+#   python3 system_id.py --inertia 0.05 --gravity logs/session_20250101_100000.csv
+#
+# The logs are the session logs server.py records at MOTOR_UPDATE_FREQUENCY in
+# SESSION_LOG_DIR (timestamp, rx_timestamp, position, velocity, current, control_mode, error, ...).
+# Samples are timed by rx_timestamp, the kernel receive time of the reply, when the log
+# has it (asyncio backend), and by the publish timestamp otherwise.
+# Logs sampled too slowly for the recommended bandwidth, such as the app's 1 Hz
+# exports, are rejected because acceleration cannot be recovered from them.
+#
+# Joint model (torques at the output shaft, current in A):
+#   Kt * i = J * a + B * v + Fc * sign(v) + tau_0 [+ G_s * sin(q) + G_c * cos(q)]
+# Position and current alone only fix the parameters relative to Kt, so the nominal
+# MIT_Params torque constant is used unless a known inertia is given with --inertia.
+
+import argparse
+import csv
+import itertools
+import sys
+import numpy as np
+
+try:
+    from TMotorCANControl.mit_can import MIT_Params
+except ImportError:
+    print("Error: TMotorCANControl library not found. Please ensure it's in your path.")
+    print("Install with: pip install git+https://github.com/mit-biomimetics/TMotorCANControl.git")
+    sys.exit(1)
+
+# Motor type and control loop rate are shared with the server so the limits match
+from motor_config import Type, MOTOR_UPDATE_FREQUENCY
+
+
+# --- Identification Settings ---
+VELOCITY_DEADBAND = 0.05 # rad/s, below this the Coulomb friction sign is treated as 0
+SMOOTHING_WINDOW = 5 # samples, moving average applied to all signals before fitting
+MAX_GAP_FACTOR = 3.0 # samples further apart than this many median periods split a segment
+CHUNK_SIZE = 20000 # CSV rows read and fitted per pass, bounding memory for long logs
+MIN_SAMPLES_PER_PERIOD = 10 # samples required per period of MAX_BANDWIDTH_HZ
+MIN_INERTIA = 1e-6 # kg*m^2, fits at or below this are rejected as unidentified
+
+# --- Gain Recommendation Settings ---
+MIN_BANDWIDTH_HZ = 1.0 # Lowest closed-loop natural frequency worth recommending
+MAX_BANDWIDTH_HZ = MOTOR_UPDATE_FREQUENCY / 20.0 # Keep the loop well below the control rate
+DAMPING_RATIO_RANGE = (0.7, 1.0) # Closed-loop damping ratios for the Kd range
+
+# Columns used from the log; everything else in the CSV is ignored
+LOG_COLUMNS = ("timestamp", "rx_timestamp", "position", "velocity", "current", "error")
+# Columns that may be absent (older logs, python-can backend) and their fill value
+OPTIONAL_COLUMNS = {"rx_timestamp": np.nan, "error": 0.0}
+
+# Rows carried from one block into the next so every smoothing/derivative window is
+# complete; build_regressors drops SMOOTHING_WINDOW // 2 + 1 samples at each block edge
+BLOCK_OVERLAP = 2 * (SMOOTHING_WINDOW // 2 + 1)
+
+
+# --- Log Loading ---
+def rows_to_log(rows, header_index: dict, mode_index) -> dict:
+    """
+    Converts a block of CSV rows into float arrays keyed by LOG_COLUMNS.
+    Rows recorded while the motor was idle are marked as NaN so they are excluded.
+    """
+    # Transpose once in C, then convert whole columns at a time
+    columns = list(zip(*rows))
+    log = {}
+    for name in LOG_COLUMNS:
+        if name not in header_index:
+            log[name] = np.full(len(rows), OPTIONAL_COLUMNS[name])
+            continue
+        raw = np.asarray(columns[header_index[name]], dtype=str)
+        log[name] = np.where(raw == '', 'nan', raw).astype(float)
+
+    if mode_index is not None:
+        idle = np.asarray(columns[mode_index], dtype=str) == "IDLE"
+        log["current"][idle] = np.nan
+    return log
+
+
+def iter_log_blocks(path: str):
+    """
+    Reads one CSV log CHUNK_SIZE rows at a time and yields each block as float arrays.
+    Each block starts with the last BLOCK_OVERLAP rows of the previous one.
+    """
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            raise ValueError(f"{path}: log contains no samples")
+        missing = [name for name in LOG_COLUMNS if name not in header and name not in OPTIONAL_COLUMNS]
+        if missing:
+            raise ValueError(f"{path}: missing columns {', '.join(missing)}")
+        header_index = {name: header.index(name) for name in LOG_COLUMNS if name in header}
+        mode_index = header.index("control_mode") if "control_mode" in header else None
+
+        carry = []
+        complete_rows = 0
+        while True:
+            block = list(itertools.islice(reader, CHUNK_SIZE))
+            if not block:
+                break
+            rows = [row for row in block if len(row) == len(header)]
+            if not rows:
+                continue
+            complete_rows += len(rows)
+            rows = carry + rows
+            carry = rows[-BLOCK_OVERLAP:]
+            yield rows_to_log(rows, header_index, mode_index)
+
+    if complete_rows == 0:
+        raise ValueError(f"{path}: log contains no complete rows")
+
+
+# --- Regressor Construction ---
+def build_regressors(log: dict, torque_constant: float, gravity: bool):
+    """
+    Builds the regressor matrix and torque vector for one block of a log.
+    Returns (A, y); rows near gaps, errors, idle samples or the block edges are dropped.
+
+    Raises:
+        ValueError when the log is sampled too slowly to identify the joint dynamics
+    """
+    # Time each sample by when its reply was received if the backend recorded it. A
+    # reply logged again on the next tick (no new reply yet) is the same sample; keeping
+    # it would add a flat step followed by a double one, which look like acceleration spikes
+    rx = log["rx_timestamp"]
+    repeated = np.concatenate(([False], np.isfinite(rx[1:]) & (rx[1:] == rx[:-1])))
+    keep = ~repeated
+    t = np.where(np.isfinite(rx), rx, log["timestamp"])[keep]
+    q, v, i, err = (log[name][keep] for name in ("position", "velocity", "current", "error"))
+
+    # Split the log into contiguous segments wherever samples are missing or unusable.
+    # Samples stay in log order: a wall-clock step backwards (NTP) shows up as dt <= 0
+    # and splits the segment instead of interleaving samples from both sides of the step
+    dt = np.diff(t)
+    median_dt = np.median(dt[dt > 0]) if np.any(dt > 0) else 0.0
+    if median_dt <= 0:
+        return np.empty((0, 6 if gravity else 4)), np.empty(0)
+    max_period = 1.0 / (MIN_SAMPLES_PER_PERIOD * MAX_BANDWIDTH_HZ)
+    if median_dt > max_period:
+        raise ValueError(f"log is sampled every {median_dt:.3f} s, but fitting up to {MAX_BANDWIDTH_HZ:.1f} Hz needs "
+                         f"{max_period:.3f} s or faster; use the server's session logs (SESSION_LOG_DIR in motor_config.py)")
+    bad = (err != 0) | ~np.isfinite(t) | ~np.isfinite(q) | ~np.isfinite(v) | ~np.isfinite(i)
+    gap = (dt <= 0) | (dt > MAX_GAP_FACTOR * median_dt) | bad[:-1] | bad[1:]
+    segment = np.concatenate(([0], np.cumsum(gap)))
+    starts = np.concatenate(([0], np.flatnonzero(gap) + 1))
+    ends = np.concatenate((starts[1:] - 1, [len(t) - 1]))
+
+    # Keep only samples whose smoothing/derivative window lies inside one segment
+    edge = SMOOTHING_WINDOW // 2 + 1
+    index = np.arange(len(t))
+    valid = (index - starts[segment] >= edge) & (ends[segment] - index >= edge)
+    t, q, v, i = np.nan_to_num(t), np.nan_to_num(q), np.nan_to_num(v), np.nan_to_num(i)
+
+    # The same moving average is applied to every column so the model stays linear in
+    # the parameters; acceleration is differentiated from the smoothed velocity against the
+    # smoothed time, since each window average sits at its mean sample time under jitter
+    smooth = lambda x: np.convolve(x, np.ones(SMOOTHING_WINDOW) / SMOOTHING_WINDOW, mode="same")
+    v_smooth = smooth(v)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        a = np.gradient(v_smooth, smooth(t)) # Non-finite only at segment breaks, which are not valid
+    friction_sign = smooth(np.where(np.abs(v) > VELOCITY_DEADBAND, np.sign(v), 0.0))
+    regressors = [a, v_smooth, friction_sign, np.ones_like(v)]
+    if gravity:
+        regressors += [smooth(np.sin(q)), smooth(np.cos(q))]
+    return np.column_stack(regressors)[valid], torque_constant * smooth(i)[valid]
+
+
+# --- Least-Squares Fit ---
+def fit_joint_model(paths, torque_constant: float, gravity: bool = False) -> dict:
+    """
+    Fits the joint model over all logs by accumulating the normal equations block by
+    block as the CSV is read, so memory stays bounded for hours of samples.
+    """
+    n_params = 6 if gravity else 4
+    gram = np.zeros((n_params, n_params))
+    moment = np.zeros(n_params)
+    y_sq = 0.0
+    n_samples = 0
+
+    for path in paths:
+        path_samples = 0
+        for log in iter_log_blocks(path):
+            try:
+                A, y = build_regressors(log, torque_constant, gravity)
+            except ValueError as e:
+                raise ValueError(f"{path}: {e}")
+            gram += A.T @ A
+            moment += A.T @ y
+            y_sq += y @ y
+            path_samples += len(y)
+        n_samples += path_samples
+        print(f"Loaded {path}: {path_samples} usable samples.")
+
+    if n_samples <= n_params:
+        raise ValueError(f"Not enough usable samples for identification ({n_samples}).")
+
+    theta, _, rank, _ = np.linalg.lstsq(gram, moment, rcond=None)
+    if rank < n_params:
+        print("Warning: logs do not excite every parameter (rank deficient); some estimates are unreliable.")
+
+    # Residual variance from the normal equations: |y - A theta|^2 = y'y - 2 theta'A'y + theta'A'A theta
+    residual_sq = max(y_sq - 2.0 * theta @ moment + theta @ gram @ theta, 0.0)
+    sigma_sq = residual_sq / (n_samples - n_params)
+    std_err = np.sqrt(np.abs(np.diag(np.linalg.pinv(gram))) * sigma_sq)
+
+    names = ["inertia", "damping", "coulomb_friction", "torque_offset", "gravity_sin", "gravity_cos"][:n_params]
+    return {
+        "params": dict(zip(names, theta)),
+        "std_err": dict(zip(names, std_err)),
+        "residual_rms": float(np.sqrt(residual_sq / n_samples)),
+        "n_samples": n_samples,
+        "torque_constant": torque_constant,
+    }
+
+
+def rescale_to_inertia(fit: dict, known_inertia: float) -> dict:
+    """
+    Re-scales a fit so its inertia equals a known inertia, which also identifies Kt.
+    """
+    scale = known_inertia / fit["params"]["inertia"]
+    return {
+        **fit,
+        "params": {name: value * scale for name, value in fit["params"].items()},
+        "std_err": {name: value * abs(scale) for name, value in fit["std_err"].items()},
+        "residual_rms": fit["residual_rms"] * abs(scale),
+        "torque_constant": fit["torque_constant"] * scale,
+    }
+
+
+# --- Gain Recommendation ---
+def recommend_gains(inertia: float, damping: float, motor_type: str = Type) -> dict:
+    """
+    Recommends Kp/Kd ranges for a PD impedance loop on the identified joint.
+    Kp spans MIN_BANDWIDTH_HZ..MAX_BANDWIDTH_HZ, Kd spans DAMPING_RATIO_RANGE at each end,
+    and both are clipped to the MIT_Params Kp/Kd limits of the motor.
+    """
+    limits = MIT_Params[motor_type]
+    inertia = max(inertia, 0.0)
+    damping = max(damping, 0.0)
+
+    omega = 2.0 * np.pi * np.array([MIN_BANDWIDTH_HZ, MAX_BANDWIDTH_HZ])
+    kp = np.clip(inertia * omega ** 2, limits['Kp_min'], limits['Kp_max'])
+    # Kd adds to the joint's own damping: 2 * zeta * sqrt(Kp * J) = Kd + B
+    zeta = np.array(DAMPING_RATIO_RANGE)
+    kd = np.clip(2.0 * zeta * np.sqrt(kp * inertia) - damping, limits['Kd_min'], limits['Kd_max'])
+    return {"kp_range": (float(kp[0]), float(kp[1])), "kd_range": (float(kd[0]), float(kd[1]))}
+
+
+# --- Command Line Entry Point ---
+def main():
+    parser = argparse.ArgumentParser(description="Fit joint dynamics from recorded motor logs and recommend Kp/Kd ranges.")
+    parser.add_argument("logs", nargs="+", help="Session logs recorded by server.py in SESSION_LOG_DIR (see motor_config.py)")
+    parser.add_argument("--motor-type", default=Type, help=f"Motor type in MIT_Params (default: {Type})")
+    parser.add_argument("--inertia", type=float, default=None, help="Known joint inertia in kg*m^2; also identifies Kt")
+    parser.add_argument("--gravity", action="store_true", help="Fit a gravity torque term in sin/cos of position")
+    args = parser.parse_args()
+
+    if args.motor_type not in MIT_Params:
+        print(f"Error: unknown motor type '{args.motor_type}'.")
+        sys.exit(1)
+
+    limits = MIT_Params[args.motor_type]
+    nominal_kt = limits['Kt_actual'] * limits['GEAR_RATIO'] # Nm/A at the output shaft
+    try:
+        fit = fit_joint_model(args.logs, nominal_kt, gravity=args.gravity)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    if fit["params"]["inertia"] <= MIN_INERTIA:
+        print(f"Error: identified inertia ({fit['params']['inertia']:.5f} kg*m^2) is not positive; "
+              "record sessions with more acceleration before tuning.")
+        sys.exit(1)
+    if args.inertia is not None:
+        if args.inertia <= 0:
+            print("Error: --inertia must be positive.")
+            sys.exit(1)
+        fit = rescale_to_inertia(fit, args.inertia)
+
+    print(f"\nIdentified joint model for {args.motor_type} ({fit['n_samples']} samples):")
+    units = {"inertia": "kg*m^2", "damping": "Nm*s/rad", "coulomb_friction": "Nm", "torque_offset": "Nm",
+             "gravity_sin": "Nm", "gravity_cos": "Nm"}
+    for name, value in fit["params"].items():
+        print(f"  {name:<17} {value: .5f} +/- {fit['std_err'][name]:.5f} {units[name]}")
+    kt_source = "from known inertia" if args.inertia is not None else "nominal, MIT_Params"
+    print(f"  {'torque_constant':<17} {fit['torque_constant']: .5f} Nm/A at output ({kt_source})")
+    print(f"  {'residual_rms':<17} {fit['residual_rms']: .5f} Nm")
+
+    gains = recommend_gains(fit["params"]["inertia"], fit["params"]["damping"], args.motor_type)
+    print(f"\nRecommended gains ({MIN_BANDWIDTH_HZ:.1f}-{MAX_BANDWIDTH_HZ:.1f} Hz, damping ratio "
+          f"{DAMPING_RATIO_RANGE[0]}-{DAMPING_RATIO_RANGE[1]}):")
+    print(f"  Kp: {gains['kp_range'][0]:.2f} - {gains['kp_range'][1]:.2f} (limits {limits['Kp_min']} - {limits['Kp_max']})")
+    print(f"  Kd: {gains['kd_range'][0]:.3f} - {gains['kd_range'][1]:.3f} (limits {limits['Kd_min']} - {limits['Kd_max']})")
+
+
+if __name__ == '__main__':
+    main()